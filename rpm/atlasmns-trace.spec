@@ -62,6 +62,8 @@ See https://www.nntb.no for details on NorNet!
 %{python3_sitelib}/AtlasMNS*.egg-info
 %{python3_sitelib}/AtlasMNS.py
 %{python3_sitelib}/AtlasMNSLogger.py
+%{python3_sitelib}/AtlasMNSRollup.py
+%{python3_sitelib}/AtlasMNSStatus.py
 %{python3_sitelib}/AtlasMNSTools.py
 %{python3_sitelib}/__pycache__/AtlasMNS*.pyc
 %{_datadir}/doc/atlasmns-trace/examples/atlasmns-database-configuration
@@ -35,22 +35,29 @@
 import collections
 import configparser
 import datetime
+import hashlib
 import io
 import ipaddress
 import os
-import psycopg2
-import pymongo
 import re
-import ripe.atlas.cousteau
 import shutil
 import signal
 import socket
-import ssl
 import sys
+import urllib.parse
 
 import AtlasMNSLogger
+import AtlasMNSRollup
 import AtlasMNSTools
 
+# The database and RIPE Atlas modules take long to import. They are only
+# imported on first use, to keep startup fast for tools not needing them.
+cousteau = AtlasMNSTools.LazyModule('ripe.atlas.cousteau')
+psycopg2 = AtlasMNSTools.LazyModule('psycopg2')
+psycopg2_extras = AtlasMNSTools.LazyModule('psycopg2.extras')
+pymongo  = AtlasMNSTools.LazyModule('pymongo')
+ssl      = AtlasMNSTools.LazyModule('ssl')
+
 
 # ###### Scheduler database columns #########################################
 ExperimentSchedule_Identifier=0
@@ -66,6 +73,83 @@ ExperimentSchedule_ProbeCost=9
 ExperimentSchedule_ProbeHostIP=10
 ExperimentSchedule_ProbeFromIP=11
 ExperimentSchedule_Info=12
+ExperimentSchedule_ProbeAPIKeyID=13
+ExperimentSchedule_ProbeIntentToken=14
+
+ExperimentScheduleColumns = \
+   'Identifier,State,LastChange,AgentMeasurementTime,AgentHostIP,AgentTrafficClass,AgentFromIP,ProbeID,ProbeMeasurementID,ProbeCost,ProbeHostIP,ProbeFromIP,Info,ProbeAPIKeyID,ProbeIntentToken'
+ExperimentScheduleColumnNames   = ExperimentScheduleColumns.split(',')
+ExperimentScheduleColumnSet     = frozenset(ExperimentScheduleColumnNames)
+ExperimentScheduleAddressColumns = [ 'AgentHostIP', 'AgentFromIP', 'ProbeHostIP', 'ProbeFromIP' ]
+
+
+# ###### Schedule entry #####################################################
+# A schedule entry keeps the columns in slots instead of a dictionary, to
+# reduce the memory usage for large schedules. For compatibility, the
+# columns can be accessed like in a dictionary (entry['State']), and
+# dict(entry) provides a dictionary. Addresses are provided as strings, as
+# obtained from the database; getAddress() parses them on first use.
+class ScheduleEntry:
+   __slots__ = ExperimentScheduleColumnNames + \
+                  [ column + 'Address' for column in ExperimentScheduleAddressColumns ]
+
+   # ###### Constructor #####################################################
+   def __init__(self, row):
+      for column, value in zip(ExperimentScheduleColumnNames, row):
+         setattr(self, column, value)
+      for column in ExperimentScheduleAddressColumns:
+         setattr(self, column + 'Address', None)
+
+
+   # ###### Dictionary-style access #########################################
+   def __getitem__(self, column):
+      if not column in ExperimentScheduleColumnSet:
+         raise KeyError(column)
+      return getattr(self, column)
+
+   def __setitem__(self, column, value):
+      if not column in ExperimentScheduleColumnSet:
+         raise KeyError(column)
+      setattr(self, column, value)
+      if column in ExperimentScheduleAddressColumns:
+         setattr(self, column + 'Address', None)   # Parse again on next use
+
+   def __contains__(self, column):
+      return column in ExperimentScheduleColumnSet
+
+   def __iter__(self):
+      return iter(ExperimentScheduleColumnNames)
+
+   def __len__(self):
+      return len(ExperimentScheduleColumnNames)
+
+   def __repr__(self):
+      return 'ScheduleEntry(' + repr(self.asDict()) + ')'
+
+   def get(self, column, default = None):
+      if column in ExperimentScheduleColumnSet:
+         return getattr(self, column)
+      return default
+
+   def keys(self):
+      return list(ExperimentScheduleColumnNames)
+
+   def items(self):
+      return [ ( column, getattr(self, column) ) for column in ExperimentScheduleColumnNames ]
+
+   def asDict(self):
+      return { column: getattr(self, column) for column in ExperimentScheduleColumnNames }
+
+
+   # ###### Get address column as ipaddress object ##########################
+   def getAddress(self, column):
+      address = getattr(self, column + 'Address')
+      if address == None:
+         value = getattr(self, column)
+         if value != None:
+            address = ipaddress.ip_address(value)
+            setattr(self, column + 'Address', address)
+      return address
 
 
 # ###### Signal handler #####################################################
@@ -75,6 +159,169 @@ def signalHandler(signalNumber, frame):
    breakDetected = True
 
 
+# ###### Reaper #############################################################
+# Info prefix of entries re-queued by the reaper (see reapStaleEntries()).
+RequeuedInfoPrefix = 'Requeued: '
+
+
+# ###### RIPE Atlas API key pool ###########################################
+# Measurements are distributed over a pool of RIPE Atlas API keys, each
+# having its own limits for concurrent measurements and daily credits.
+# The key used for a measurement is stored with the schedule entry, by its
+# key ID (the API key itself is not stored in the database).
+# A key is blocked only on errors concerning the key (or its account), not
+# on errors concerning a single target.
+RIPEAtlasKeyBlockTime       = datetime.timedelta(seconds = 60)   # API request rate limit of key
+RIPEAtlasKeyCreditBlockTime = datetime.timedelta(hours = 1)      # Credits/quota exhausted
+
+
+# ###### Get key ID of RIPE Atlas API key ###################################
+def makeRIPEAtlasKeyID(key):
+   return hashlib.sha256(key.encode('utf-8')).hexdigest()[0:16]
+
+
+# ###### Split cost of RIPE Atlas measurement over its entries #############
+# The first entry also gets the remainder, so that the sum is the cost.
+def splitRIPEAtlasCost(scheduledEntries, cost):
+   for scheduledEntry in scheduledEntries:
+      scheduledEntry['ProbeCost'] = int(cost / len(scheduledEntries))
+   scheduledEntries[0]['ProbeCost'] = scheduledEntries[0]['ProbeCost'] + cost % len(scheduledEntries)
+
+
+# ###### Compact RIPE Atlas traceroute result format ########################
+# RIPE Atlas traceroute results can be stored in a compact format, similar
+# to the HiPerConTracer results: addresses are packed binary, RTTs are
+# integers in microseconds, and keys are short. msm_id, prb_id and
+# timestamp are kept, since they are used for queries. Format:
+# { 'v': 1, 'msm_id': ..., 'prb_id': ..., 'timestamp': ...,
+#   's': src_addr, 'f': from, 'd': dst_addr,
+#   'h': [ [ hop, [ reply | None (for "*"), ... ] (, { other hop fields }) ], ... ],
+#   <short key>: <value> for the keys in RIPEAtlasShortKeys,
+#   <key>: <value> for any other key }
+# reply: [ from, rtt in us, ttl, size (, { other reply fields }) ]
+RIPEAtlasCompactVersion = 1
+RIPEAtlasShortKeys = {
+   'af':       'a',
+   'dst_name': 'n',
+   'endtime':  'e',
+   'fw':       'w',
+   'group_id': 'g',
+   'lts':      'l',
+   'msm_name': 'm',
+   'paris_id': 'i',
+   'proto':    'p',
+   'size':     'z',
+   'type':     't'
+}
+RIPEAtlasLongKeys = { shortKey: key for key, shortKey in RIPEAtlasShortKeys.items() }
+RIPEAtlasAddressKeys = { 'src_addr': 's', 'from': 'f', 'dst_addr': 'd' }
+RIPEAtlasLongAddressKeys = { shortKey: key for key, shortKey in RIPEAtlasAddressKeys.items() }
+
+
+# ###### Pack IP address, if possible #######################################
+def packAddress(address):
+   try:
+      return AtlasMNSTools.ipAddressToBinary(ipaddress.ip_address(address))
+   except ValueError:
+      return address
+
+
+# ###### Unpack IP address, if packed #######################################
+def unpackAddress(address):
+   if isinstance(address, bytes):
+      return str(AtlasMNSTools.binaryToIPAddress(address))
+   return address
+
+
+# ###### Encode RIPE Atlas traceroute result in compact format ##############
+def encodeRIPEAtlasResult(result):
+   if result.get('v') == RIPEAtlasCompactVersion:
+      return result   # Already compact
+
+   compact = { 'v': RIPEAtlasCompactVersion }
+   for key, value in result.items():
+      if key in RIPEAtlasAddressKeys:
+         compact[RIPEAtlasAddressKeys[key]] = packAddress(value)
+      elif key == 'result':
+         hops = []
+         for hop in value:
+            replies = None
+            if 'result' in hop:
+               replies = []
+               for reply in hop['result']:
+                  if reply == { 'x': '*' }:
+                     replies.append(None)
+                  else:
+                     rtt = reply.get('rtt')
+                     compactReply = [ packAddress(reply['from']) if 'from' in reply else None,
+                                      int(round(1000.0 * rtt)) if rtt != None else None,
+                                      reply.get('ttl'),
+                                      reply.get('size') ]
+                     others = { k: v for k, v in reply.items() if not k in [ 'from', 'rtt', 'ttl', 'size' ] }
+                     if len(others) > 0:
+                        compactReply.append(others)
+                     replies.append(compactReply)
+            compactHop = [ hop.get('hop'), replies ]
+            others = { k: v for k, v in hop.items() if not k in [ 'hop', 'result' ] }
+            if len(others) > 0:
+               compactHop.append(others)
+            hops.append(compactHop)
+         compact['h'] = hops
+      elif key in RIPEAtlasShortKeys:
+         compact[RIPEAtlasShortKeys[key]] = value
+      else:
+         compact[key] = value
+   return compact
+
+
+# ###### Decode RIPE Atlas traceroute result from compact format ############
+# Results not in compact format are returned unchanged.
+def decodeRIPEAtlasResult(compact):
+   if compact.get('v') != RIPEAtlasCompactVersion:
+      return compact
+
+   result = { }
+   for key, value in compact.items():
+      if key == 'v':
+         continue
+      elif key in RIPEAtlasLongAddressKeys:
+         result[RIPEAtlasLongAddressKeys[key]] = unpackAddress(value)
+      elif key == 'h':
+         hops = []
+         for compactHop in value:
+            hop = { }
+            if compactHop[0] != None:
+               hop['hop'] = compactHop[0]
+            if compactHop[1] != None:
+               replies = []
+               for compactReply in compactHop[1]:
+                  if compactReply == None:
+                     replies.append({ 'x': '*' })
+                  else:
+                     reply = { }
+                     if compactReply[0] != None:
+                        reply['from'] = unpackAddress(compactReply[0])
+                     if compactReply[1] != None:
+                        reply['rtt'] = compactReply[1] / 1000.0
+                     if compactReply[2] != None:
+                        reply['ttl'] = compactReply[2]
+                     if compactReply[3] != None:
+                        reply['size'] = compactReply[3]
+                     if len(compactReply) > 4:
+                        reply.update(compactReply[4])
+                     replies.append(reply)
+               hop['result'] = replies
+            if len(compactHop) > 2:
+               hop.update(compactHop[2])
+            hops.append(hop)
+         result['result'] = hops
+      elif key in RIPEAtlasLongKeys:
+         result[RIPEAtlasLongKeys[key]] = value
+      else:
+         result[key] = value
+   return result
+
+
 # ###### AtlasMNS class #####################################################
 class AtlasMNS:
 
@@ -95,13 +342,27 @@ class AtlasMNS:
          'results_dbpassword':   None,
          'results_database':     'atlasmnsdb',
          'results_cafile':       'None',
+         'results_ripeatlas_format': 'json',
+         'results_bucketing':    'none',
+
+         'atlas_api_key':        None,
+         'atlas_api_keys':       None,
+         'atlas_key_max_concurrent': '100',
+         'atlas_key_daily_credits':  '1000000',
 
-         'atlas_api_key':        None
+         'agent_timeout':        '10800',
+         'agent_timeout_action': 'fail',
+         'scheduler_status_socket': None
       }
       self.scheduler_dbConnection = None
       self.scheduler_dbCursor     = None
+      self.scheduler_cursorNumber = 0
+      self.scheduler_iterationFailed = False
       self.results_dbConnection   = None
       self.results_db             = None
+      self.results_buckets        = set()
+      self.atlas_keys             = collections.OrderedDict()
+      self.rollup_indexReady      = False
       signal.signal(signal.SIGINT, signalHandler)
       signal.signal(signal.SIGTERM, signalHandler)
 
@@ -144,13 +405,66 @@ class AtlasMNS:
             self.configuration['results_database'] = parameterValue
          elif parameterName == 'results_cafile':
             self.configuration['results_cafile'] = parameterValue
+         elif parameterName == 'results_ripeatlas_format':
+            if not parameterValue in [ 'json', 'compact' ]:
+               AtlasMNSLogger.error('Bad value for results_ripeatlas_format: ' + parameterValue)
+               return False
+            self.configuration['results_ripeatlas_format'] = parameterValue
+         elif parameterName == 'results_bucketing':
+            if not parameterValue in [ 'none', 'monthly' ]:
+               AtlasMNSLogger.error('Bad value for results_bucketing: ' + parameterValue)
+               return False
+            self.configuration['results_bucketing'] = parameterValue
 
          elif parameterName == 'atlas_api_key':
             self.configuration['atlas_api_key'] = parameterValue
+         elif parameterName == 'atlas_api_keys':
+            self.configuration['atlas_api_keys'] = parameterValue
+         elif ((parameterName == 'atlas_key_max_concurrent') or
+               (parameterName == 'atlas_key_daily_credits')):
+            if not parameterValue.isdigit():
+               AtlasMNSLogger.error('Bad value for ' + parameterName + ': ' + parameterValue)
+               return False
+            self.configuration[parameterName] = parameterValue
+
+         elif parameterName == 'agent_timeout':
+            if not parameterValue.isdigit():
+               AtlasMNSLogger.error('Bad value for agent_timeout: ' + parameterValue)
+               return False
+            self.configuration['agent_timeout'] = parameterValue
+         elif parameterName == 'agent_timeout_action':
+            if not parameterValue in [ 'fail', 'requeue' ]:
+               AtlasMNSLogger.error('Bad value for agent_timeout_action: ' + parameterValue)
+               return False
+            self.configuration['agent_timeout_action'] = parameterValue
+         elif parameterName == 'scheduler_status_socket':
+            if parameterValue.upper() in [ '', 'NONE' ]:
+               self.configuration['scheduler_status_socket'] = None
+            else:
+               self.configuration['scheduler_status_socket'] = parameterValue
 
          else:
             AtlasMNSLogger.warning('Unknown parameter ' + parameterName + ' is ignored!')
 
+      # ====== Set up RIPE Atlas API key pool ===============================
+      # atlas_api_key (if set) is the first key of the pool. It is also
+      # used for entries without key ID, scheduled before having the pool.
+      keys = [ ]
+      if self.configuration['atlas_api_key'] != None:
+         keys.append(self.configuration['atlas_api_key'])
+      if self.configuration['atlas_api_keys'] != None:
+         keys = keys + self.configuration['atlas_api_keys'].replace(',', ' ').split()
+      self.atlas_keys = collections.OrderedDict()
+      for key in keys:
+         if key != 'PROVIDE_ATLAS_API_KEY_HERE':
+            self.atlas_keys[makeRIPEAtlasKeyID(key)] = {
+               'Key':          key,
+               'InFlight':     0,
+               'CreditsUsed':  0,
+               'CreditsDay':   None,
+               'BlockedUntil': None
+            }
+
       return True
 
 
@@ -158,12 +472,12 @@ class AtlasMNS:
    def connectToRIPEAtlas(self):
       AtlasMNSLogger.info('Connecting to the RIPE Atlas server ...')
 
-      if ((self.configuration['atlas_api_key'] == None) or
-          (self.configuration['atlas_api_key'] == 'PROVIDE_ATLAS_API_KEY_HERE')):
+      if len(self.atlas_keys) == 0:
          AtlasMNSLogger.error('No RIPE Atlas API Key specified!')
          return False
+      AtlasMNSLogger.info('Using ' + str(len(self.atlas_keys)) + ' RIPE Atlas API keys')
 
-      atlas_request = ripe.atlas.cousteau.AtlasRequest(
+      atlas_request = cousteau.AtlasRequest(
          **{
             'url_path': '/api/v2/anchors'
          }
@@ -174,12 +488,132 @@ class AtlasMNS:
       return (result.success == True)
 
 
+   # ###### Get RIPE Atlas API key for key ID ##############################
+   # Entries without key ID (or with a key no longer configured) use the
+   # first key of the pool.
+   def getRIPEAtlasKey(self, keyID = None):
+      keyUsage = self.atlas_keys.get(keyID)
+      if keyUsage == None:
+         if keyID != None:
+            AtlasMNSLogger.warning('RIPE Atlas API key ' + str(keyID) + ' is not configured -> using default key')
+         if len(self.atlas_keys) == 0:
+            return None
+         keyUsage = next(iter(self.atlas_keys.values()))
+      return keyUsage['Key']
+
+
+   # ###### Update usage of RIPE Atlas API keys from schedule ###############
+   # The number of in-flight measurements per key is recomputed from the
+   # schedule, i.e. it is also correct after a restart of the scheduler.
+   # The daily credits are loaded from the schedule once per day (see
+   # loadRIPEAtlasKeyCredits()), and then tracked in memory.
+   def updateRIPEAtlasKeyUsage(self, schedule):
+      measurements = { keyID: set() for keyID in self.atlas_keys.keys() }
+      defaultKeyID = next(iter(self.atlas_keys.keys()), None)
+      for scheduledEntry in schedule:
+         if scheduledEntry['State'] == 'atlas_scheduled':
+            keyID = scheduledEntry['ProbeAPIKeyID']
+            if not keyID in measurements:
+               keyID = defaultKeyID
+            if keyID != None:
+               measurements[keyID].add(scheduledEntry['ProbeMeasurementID'])
+      for keyID, keyUsage in self.atlas_keys.items():
+         keyUsage['InFlight'] = len(measurements[keyID])
+
+
+   # ###### Load today's credit usage of RIPE Atlas API keys ###############
+   # The credits are summed up from the entries with a measurement, changed
+   # since the beginning of the UTC day. Since entries only have the time of
+   # their last change, this may overestimate the usage, but it survives
+   # restarts of the scheduler.
+   def loadRIPEAtlasKeyCredits(self, today):
+      for keyUsage in self.atlas_keys.values():
+         keyUsage['CreditsDay']  = today
+         keyUsage['CreditsUsed'] = 0
+
+      for stage in [ 1, 2 ]:
+         try:
+            if self.scheduler_dbCursor == None:
+               raise psycopg2.Error('Disconnected from database')
+            self.scheduler_dbCursor.execute("""
+               SELECT ProbeAPIKeyID, SUM(ProbeCost)
+               FROM ExperimentSchedule
+               WHERE
+                  ProbeMeasurementID IS NOT NULL AND
+                  LastChange >= (DATE_TRUNC('day', NOW() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC')::TIMESTAMP
+               GROUP BY ProbeAPIKeyID
+               """)
+            table = self.scheduler_dbCursor.fetchall()
+            self.scheduler_dbConnection.commit()
+            break
+         except psycopg2.Error as e:
+            self.connectToSchedulerDB()
+            if stage == 2:
+               AtlasMNSLogger.warning('Failed to load credit usage of RIPE Atlas API keys: ' + str(e).strip())
+               return False
+
+      defaultKeyID = next(iter(self.atlas_keys.keys()), None)
+      for row in table:
+         keyID = row[0].strip() if row[0] != None else None
+         if not keyID in self.atlas_keys:
+            keyID = defaultKeyID   # Entries without (or with unknown) key ID
+         if keyID != None:
+            self.atlas_keys[keyID]['CreditsUsed'] = self.atlas_keys[keyID]['CreditsUsed'] + int(row[1])
+      return True
+
+
+   # ###### Select least-loaded RIPE Atlas API key ##########################
+   # Returns the key ID, or None if all keys have reached their limits.
+   def selectRIPEAtlasKey(self, cost):
+      now           = datetime.datetime.now()
+      today         = datetime.datetime.utcnow().date()   # RIPE Atlas days are UTC
+      maxConcurrent = int(self.configuration['atlas_key_max_concurrent'])
+      dailyCredits  = int(self.configuration['atlas_key_daily_credits'])
+      selectedKeyID = None
+      for keyUsage in self.atlas_keys.values():
+         if keyUsage['CreditsDay'] != today:
+            self.loadRIPEAtlasKeyCredits(today)
+            break
+      for keyID, keyUsage in self.atlas_keys.items():
+         if ((keyUsage['BlockedUntil'] != None) and (now < keyUsage['BlockedUntil'])):
+            continue
+         if keyUsage['InFlight'] >= maxConcurrent:
+            continue
+         if ((dailyCredits > 0) and (keyUsage['CreditsUsed'] + cost > dailyCredits)):
+            continue
+         if ((selectedKeyID == None) or
+             ((keyUsage['InFlight'], keyUsage['CreditsUsed']) <
+              (self.atlas_keys[selectedKeyID]['InFlight'], self.atlas_keys[selectedKeyID]['CreditsUsed']))):
+            selectedKeyID = keyID
+      return selectedKeyID
+
+
+   # ###### Charge credits to RIPE Atlas API key ###########################
+   # For measurements not created by startRIPEAtlasMeasurement(), e.g. when
+   # re-attaching to a measurement after a crash.
+   def chargeRIPEAtlasKey(self, keyID, cost):
+      keyUsage = self.atlas_keys.get(keyID)
+      if keyUsage == None:
+         keyUsage = next(iter(self.atlas_keys.values()), None)
+      if keyUsage != None:
+         keyUsage['CreditsUsed'] = keyUsage['CreditsUsed'] + cost
+
+
    # ###### Start RIPE Atlas measurement ####################################
-   def startRIPEAtlasMeasurement(self, source, measurement):
+   # Returns ( measurementID, keyID, info ). measurementID and info are
+   # None for a recoverable failure, i.e. the creation should be retried.
+   def startRIPEAtlasMeasurement(self, source, measurement, cost):
+      keyID = self.selectRIPEAtlasKey(cost)
+      if keyID == None:
+         AtlasMNSLogger.trace('All RIPE Atlas API keys are busy -> retry again later')
+         return ( None, None, None )
+      keyUsage = self.atlas_keys[keyID]
+
       AtlasMNSLogger.trace('Creating ' + measurement.measurement_type + ' measurement for ' +
-                           'Probe #' + str(source.get_value()) + ' to ' + str(measurement.target) + ' ...')
-      atlas_request = ripe.atlas.cousteau.AtlasCreateRequest(
-         key          = self.configuration['atlas_api_key'],
+                           'Probe #' + str(source.get_value()) + ' to ' + str(measurement.target) +
+                           ' with key ' + keyID + ' ...')
+      atlas_request = cousteau.AtlasCreateRequest(
+         key          = keyUsage['Key'],
          sources      = [ source ],
          measurements = [ measurement ],
          is_oneoff    = True
@@ -189,34 +623,96 @@ class AtlasMNS:
       ( is_success, response ) = atlas_request.create()
       if is_success:
          measurementID = response['measurements'][0]
+         keyUsage['InFlight']    = keyUsage['InFlight'] + 1
+         keyUsage['CreditsUsed'] = keyUsage['CreditsUsed'] + cost
          AtlasMNSLogger.trace('Created ' + measurement.measurement_type + ' measurement: ' +
                               'Probe #' + str(source.get_value()) + ' to ' + str(measurement.target) +
                               ' -> Measurement #' + str(measurementID))
-         return ( measurementID, None )
+         return ( measurementID, keyID, None )
 
       # ====== Failure ======================================================
       else:
          # ====== Check for recoverable failure =============================
          detail = None
+         status = None
          try:
             detail = str(response['error']['errors'][0]['detail'])
          except:
             pass
+         try:
+            status = int(response['error']['status'])
+         except:
+            pass
+         # Too many measurements to the target are already scheduled. This
+         # only concerns the target, i.e. the key is not blocked:
          if ((detail != None) and (detail.find('We do not allow more than ') == 0)):
             AtlasMNSLogger.trace('Retry again later: ' + detail)
-            return ( None, None )
+            return ( None, None, None )
+         # The key has exceeded the API request rate limit:
+         if ((status == 429) or
+             ((detail != None) and
+              ((detail.lower().find('throttled') >= 0) or
+               (detail.lower().find('too many requests') >= 0)))):
+            AtlasMNSLogger.warning('RIPE Atlas API key ' + keyID + ' is blocked for ' +
+                                   str(RIPEAtlasKeyBlockTime) + ': ' + str(detail))
+            keyUsage['BlockedUntil'] = datetime.datetime.now() + RIPEAtlasKeyBlockTime
+            return ( None, None, None )
+         # The key has run out of credits, or exceeded a spending limit or
+         # quota -> try again later, possibly with another key:
+         if ((detail != None) and
+             ((detail.lower().find('credit') >= 0) or
+              (detail.lower().find('quota') >= 0) or
+              (detail.lower().find('spending limit') >= 0))):
+            AtlasMNSLogger.warning('RIPE Atlas API key ' + keyID + ' is blocked for ' +
+                                   str(RIPEAtlasKeyCreditBlockTime) + ': ' + detail)
+            keyUsage['BlockedUntil'] = datetime.datetime.now() + RIPEAtlasKeyCreditBlockTime
+            return ( None, None, None )
 
          # ====== Non-recoverable failure ===================================
          AtlasMNSLogger.warning('Creating ' + measurement.measurement_type + ' measurement for ' +
                                 'Probe #' + str(source.get_value()) + ' to ' + str(measurement.target) +
                                 ' failed: ' + str(response))
-         return ( None, response )
+         return ( None, None, response )
+
+
+   # ###### Find RIPE Atlas measurements by description token ##############
+   # Searches the own measurements of all keys of the pool for the token.
+   # NOTE: AtlasRequest sends the key in the Authorization header, i.e. it
+   #       does not appear in the URL (and therefore not in any logs).
+   # Returns a sorted list of ( measurementID, keyID ), or None on error.
+   def findRIPEAtlasMeasurements(self, token):
+      measurements = [ ]
+      for keyID, keyUsage in self.atlas_keys.items():
+         urlPath = '/api/v2/measurements/my/?fields=id&description__contains=' + \
+                      urllib.parse.quote(token)
+         while urlPath != None:
+            try:
+               atlas_request = cousteau.AtlasRequest(
+                  **{
+                     'url_path': urlPath,
+                     'key':      keyUsage['Key']
+                  }
+               )
+               ( is_success, response ) = atlas_request.get()
+               if not is_success:
+                  raise Exception(str(response))
+               for measurement in response['results']:
+                  measurements.append(( int(measurement['id']), keyID ))
+               # ====== Next page ==========================================
+               urlPath = None
+               if response.get('next') != None:
+                  nextURL = urllib.parse.urlsplit(response['next'])
+                  urlPath = nextURL.path + '?' + nextURL.query
+            except Exception as e:
+               AtlasMNSLogger.warning('Searching measurements for ' + token + ' failed: ' + str(e))
+               return None
+      return sorted(measurements)
 
 
    # ###### Stop RIPE Atlas measurement #####################################
-   def stopRIPEAtlasMeasurement(self, measurementID):
-      atlas_request = ripe.atlas.cousteau.AtlasStopRequest(
-         key    = self.configuration['atlas_api_key'],
+   def stopRIPEAtlasMeasurement(self, measurementID, keyID = None):
+      atlas_request = cousteau.AtlasStopRequest(
+         key    = self.getRIPEAtlasKey(keyID),
          msm_id = measurementID
       )
       ( is_success, response ) = atlas_request.create()
@@ -231,7 +727,7 @@ class AtlasMNS:
 
    # ###### Create RIPE Atlas Ping measurement ##############################
    def createRIPEAtlasPingMeasurement(self, probeID, targetAddress, description):
-      source = ripe.atlas.cousteau.AtlasSource(
+      source = cousteau.AtlasSource(
          type      = 'probes',
          value     = str(probeID),
          requested = 1
@@ -243,8 +739,14 @@ class AtlasMNS:
       packets   = 1
       size      = 16
 
+      # Cost calculation:
+      # https://atlas.ripe.net/docs/credits/
+      costs = packets * (int(size / 1500) + 1)
+      if is_oneoff:
+         costs = 2 * costs
+
       try:
-         measurement = ripe.atlas.cousteau.Ping(
+         measurement = cousteau.Ping(
             af          = targetAddress.version,
             target      = str(targetAddress),
             description = description,
@@ -253,26 +755,31 @@ class AtlasMNS:
             paris       = 1,
             size        = size   # size without IP and ICMP headers
          )
-         ( measurementID, info ) = self.startRIPEAtlasMeasurement(source, measurement)
+         ( measurementID, keyID, info ) = self.startRIPEAtlasMeasurement(source, measurement, costs)
       except Exception as e:
          measurementID = None
+         keyID         = None
          info          = str(e)
          AtlasMNSLogger.warning('Creating Ping experiment failed: ' + info)
 
-      # Cost calculation:
-      # https://atlas.ripe.net/docs/credits/
-      if measurementID != None:
-         costs = packets * (int(size / 1500) + 1)
-         if is_oneoff:
-            costs = 2 * costs
-      else:
+      if measurementID == None:
          costs = 0
-      return ( measurementID, costs, info )
+      return ( measurementID, costs, info, keyID )
+
+
+   # ###### Get cost of RIPE Atlas Traceroute measurement ##################
+   # Cost calculation:
+   # https://atlas.ripe.net/docs/credits/
+   def getRIPEAtlasTracerouteCost(self, is_oneoff = True, packets = 1, size = 16):
+      costs = 10 * packets * (int(size / 1500) + 1)
+      if is_oneoff:
+         costs = 2 * costs
+      return costs
 
 
    # ###### Create RIPE Atlas Traceroute measurement ########################
    def createRIPEAtlasTracerouteMeasurement(self, probeID, targetAddress, description):
-      source = ripe.atlas.cousteau.AtlasSource(
+      source = cousteau.AtlasSource(
          type      = 'probes',
          value     = str(probeID),
          requested = 1
@@ -283,9 +790,10 @@ class AtlasMNS:
       is_oneoff = True
       packets   = 1
       size      = 16
+      costs     = self.getRIPEAtlasTracerouteCost(is_oneoff, packets, size)
 
       try:
-         measurement = ripe.atlas.cousteau.Traceroute(
+         measurement = cousteau.Traceroute(
             af          = targetAddress.version,
             target      = str(targetAddress),
             description = description,
@@ -295,28 +803,24 @@ class AtlasMNS:
             paris       = 1,
             size        = size   # size without IP and ICMP headers
          )
-         ( measurementID, info ) = self.startRIPEAtlasMeasurement(source, measurement)
+         ( measurementID, keyID, info ) = self.startRIPEAtlasMeasurement(source, measurement, costs)
       except Exception as e:
          measurementID = None
+         keyID         = None
          info          = str(e)
          AtlasMNSLogger.warning('Creating Traceroute experiment failed: ' + info)
 
-      # Cost calculation:
-      # https://atlas.ripe.net/docs/credits/
-      if measurementID != None:
-         costs = 10 * packets * (int(size / 1500) + 1)
-         if is_oneoff:
-            costs = 2 * costs
-      else:
+      if measurementID == None:
          costs = 0
-      return ( measurementID, costs, info )
+      return ( measurementID, costs, info, keyID )
 
 
    # ###### Obtain measurement results ######################################
-   def downloadRIPEAtlasMeasurementResults(self, measurementID):
+   def downloadRIPEAtlasMeasurementResults(self, measurementID, keyID = None):
       AtlasMNSLogger.trace('Downloading results for Measurement #' +
                            str(measurementID) + ' ...')
-      (is_success, results) = ripe.atlas.cousteau.AtlasResultsRequest(
+      (is_success, results) = cousteau.AtlasResultsRequest(
+         key    = self.getRIPEAtlasKey(keyID),
          msm_id = measurementID
       ).create()
       if is_success:
@@ -339,7 +843,7 @@ class AtlasMNS:
       print('Metadata:')
       for probeID in probeIDs:
          print('- Metadata for Probe #' + str(probeID))
-         probe  = ripe.atlas.cousteau.Probe(id = probeID)
+         probe  = cousteau.Probe(id = probeID)
          print('  ', probe.country_code, probe.address_v4, probe.asn_v4, probe.address_v6, probe.asn_v6)
 
 
@@ -392,6 +896,7 @@ class AtlasMNS:
 
 
    # ###### Query schedule from scheduler database ##########################
+   # Returns the list of schedule entries, or None in case of error.
    def querySchedule(self, identifier = None):
       # ====== Query database ===============================================
       AtlasMNSLogger.trace('Querying schedule ...')
@@ -401,7 +906,8 @@ class AtlasMNS:
                raise psycopg2.Error('Disconnected from database')
             if identifier != None:
                self.scheduler_dbCursor.execute("""
-                  SELECT * FROM ExperimentSchedule
+                  SELECT """ + ExperimentScheduleColumns + """
+                  FROM ExperimentSchedule
                   WHERE
                      Identifier = %(Identifier)s
                   """, {
@@ -409,7 +915,7 @@ class AtlasMNS:
                   })
             else:
                self.scheduler_dbCursor.execute("""
-                  SELECT Identifier,State,LastChange,AgentMeasurementTime,AgentHostIP,AgentTrafficClass,AgentFromIP,ProbeID,ProbeMeasurementID,ProbeCost,ProbeHostIP,ProbeFromIP,Info
+                  SELECT """ + ExperimentScheduleColumns + """
                   FROM ExperimentSchedule
                   ORDER BY LastChange ASC;
                   """)
@@ -419,87 +925,142 @@ class AtlasMNS:
             self.connectToSchedulerDB()
             if stage == 2:
                AtlasMNSLogger.warning('Failed to query schedule: ' + str(e).strip())
-               return []
+               return None
 
-      # ====== Provide result as list of dictionaries =======================
-      schedule = []
-      for row in table:
-         schedule.append({
-            'Identifier':           row[0],
-            'State':                row[1],
-            'LastChange':           row[2],
-            'AgentMeasurementTime': row[3],
-            'AgentHostIP':          row[4],
-            'AgentTrafficClass':    row[5],
-            'AgentFromIP':          row[6],
-            'ProbeID':              row[7],
-            'ProbeMeasurementID':   row[8],
-            'ProbeCost':            row[9],
-            'ProbeHostIP':          row[10],
-            'ProbeFromIP':          row[11],
-            'Info':                 row[12]
-         })
+      # ====== Provide result as list of schedule entries ===================
+      schedule = [ ScheduleEntry(row) for row in table ]
       # print(schedule)
       return schedule
 
 
+   # ###### Iterate over schedule from scheduler database ###################
+   # The schedule is streamed in batches from a server-side cursor, instead
+   # of fetching it at once. The cursor is held over commits, i.e. entries
+   # can be updated during the iteration. On an error, the iteration ends
+   # early and scheduler_iterationFailed is set, i.e. the caller can check
+   # after the iteration whether it has seen the complete schedule.
+   def iterSchedule(self, batchSize = 1000):
+      AtlasMNSLogger.trace('Iterating schedule ...')
+      self.scheduler_iterationFailed = False
+      scheduleCursor = None
+      for stage in [ 1, 2 ]:
+         try:
+            if self.scheduler_dbConnection == None:
+               raise psycopg2.Error('Disconnected from database')
+            self.scheduler_cursorNumber = self.scheduler_cursorNumber + 1
+            scheduleCursor = self.scheduler_dbConnection.cursor(
+               name = 'schedule' + str(self.scheduler_cursorNumber), withhold = True)
+            scheduleCursor.itersize = batchSize
+            scheduleCursor.execute("""
+               SELECT """ + ExperimentScheduleColumns + """
+               FROM ExperimentSchedule
+               ORDER BY LastChange ASC;
+               """)
+            break
+         except psycopg2.Error as e:
+            scheduleCursor = None
+            self.connectToSchedulerDB()
+            if stage == 2:
+               AtlasMNSLogger.warning('Failed to query schedule: ' + str(e).strip())
+               self.scheduler_iterationFailed = True
+               return
+
+      try:
+         for row in scheduleCursor:
+            yield ScheduleEntry(row)
+      except psycopg2.Error as e:
+         AtlasMNSLogger.warning('Failed to iterate schedule: ' + str(e).strip())
+         self.scheduler_iterationFailed = True
+         self.connectToSchedulerDB()
+      finally:
+         try:
+            scheduleCursor.close()
+            self.scheduler_dbConnection.commit()
+         except (psycopg2.Error, AttributeError):
+            pass
+
+
    # ###### Add measurement run #############################################
+   # A run which is already pending (i.e. neither failed nor finished) is
+   # skipped. Returns True on success, also when skipping a duplicate.
    def addMeasurementRun(self, agentHostIP, agentTrafficClass, agentFromIP, probeID):
+      added = self.addMeasurementRuns([ ( agentHostIP, agentTrafficClass, agentFromIP, probeID ) ])
+      if added == None:
+         return False
+      elif added == 0:
+         AtlasMNSLogger.info('Measurement run is already scheduled -> skipped')
+      return True
+
+
+   # ###### Add measurement runs ############################################
+   # runs is a list of (agentHostIP, agentTrafficClass, agentFromIP, probeID)
+   # tuples. Runs which are already pending are skipped. Returns the number
+   # of added runs, or None in case of error.
+   def addMeasurementRuns(self, runs):
+      values = [ ( str(agentHostIP), int(agentTrafficClass), str(agentFromIP), int(probeID) )
+                 for ( agentHostIP, agentTrafficClass, agentFromIP, probeID ) in runs ]
       for stage in [ 1, 2 ]:
          try:
             if self.scheduler_dbCursor == None:
                raise psycopg2.Error('Disconnected from database')
-            self.scheduler_dbCursor.execute("""
+            added = psycopg2_extras.execute_values(self.scheduler_dbCursor, """
                INSERT INTO ExperimentSchedule (AgentHostIP,AgentTrafficClass,AgentFromIP,ProbeID)
-               VALUES (%(AgentHostIP)s,%(AgentTrafficClass)s,%(AgentFromIP)s,%(ProbeID)s)
-               """, {
-                  'AgentHostIP':       str(agentHostIP),
-                  'AgentTrafficClass': int(agentTrafficClass),
-                  'AgentFromIP':       str(agentFromIP),
-                  'ProbeID':           int(probeID)
-               })
+               VALUES %s
+               ON CONFLICT (AgentHostIP,AgentTrafficClass,AgentFromIP,ProbeID)
+                  WHERE State NOT IN ('failed', 'finished')
+               DO NOTHING
+               RETURNING Identifier
+               """, values, template = '(%s::INET,%s,%s::INET,%s)', page_size = 1000, fetch = True)
             self.scheduler_dbConnection.commit()
             break
          except psycopg2.Error as e:
             self.connectToSchedulerDB()
             if stage == 2:
-               print('Unable to add measurement run: ' + str(e).strip())
-               return False
+               AtlasMNSLogger.warning('Unable to add measurement runs: ' + str(e).strip())
+               return None
 
-      return True
+      return len(added)
 
 
    # ###### Remove measurement run ##########################################
    def removeMeasurementRun(self, agentHostIP, agentTrafficClass, agentFromIP, probeID):
+      removed = self.removeMeasurementRuns([ ( agentHostIP, agentTrafficClass, agentFromIP, probeID ) ])
+      return (removed != None)
+
+
+   # ###### Remove measurement runs #########################################
+   # runs is a list of (agentHostIP, agentTrafficClass, agentFromIP, probeID)
+   # tuples. Returns the number of removed runs, or None in case of error.
+   def removeMeasurementRuns(self, runs):
+      values = [ ( str(agentHostIP), int(agentTrafficClass), str(agentFromIP), int(probeID) )
+                 for ( agentHostIP, agentTrafficClass, agentFromIP, probeID ) in runs ]
       for stage in [ 1, 2 ]:
          try:
             if self.scheduler_dbCursor == None:
                raise psycopg2.Error('Disconnected from database')
-            self.scheduler_dbCursor.execute("""
+            removed = psycopg2_extras.execute_values(self.scheduler_dbCursor, """
                DELETE FROM ExperimentSchedule
+               USING (VALUES %s) AS Run(AgentHostIP,AgentTrafficClass,AgentFromIP,ProbeID)
                WHERE
-                  AgentHostIP = %(AgentHostIP)s AND
-                  AgentTrafficClass = %(AgentTrafficClass)s AND
-                  AgentFromIP = %(AgentFromIP)s AND
-                  ProbeID = %(ProbeID)s
-               """, {
-                  'AgentHostIP':       str(agentHostIP),
-                  'AgentTrafficClass': int(agentTrafficClass),
-                  'AgentFromIP':       str(agentFromIP),
-                  'ProbeID':           int(probeID)
-               })
+                  ExperimentSchedule.AgentHostIP = Run.AgentHostIP AND
+                  ExperimentSchedule.AgentTrafficClass = Run.AgentTrafficClass AND
+                  ExperimentSchedule.AgentFromIP = Run.AgentFromIP AND
+                  ExperimentSchedule.ProbeID = Run.ProbeID
+               RETURNING ExperimentSchedule.Identifier
+               """, values, template = '(%s::INET,%s::SMALLINT,%s::INET,%s::INTEGER)', page_size = 1000, fetch = True)
             self.scheduler_dbConnection.commit()
             break
          except psycopg2.Error as e:
             self.connectToSchedulerDB()
             if stage == 2:
-               print('Unable to list measurement runs: ' + str(e).strip())
-               return False
+               AtlasMNSLogger.warning('Unable to remove measurement runs: ' + str(e).strip())
+               return None
 
-      return True
+      return len(removed)
 
 
    # ###### Query agents from scheduler database ############################
+   # Returns the list of agents, or None in case of error.
    def queryAgents(self):
       # ====== Query database ===============================================
       AtlasMNSLogger.trace('Querying agents ...')
@@ -517,7 +1078,7 @@ class AtlasMNS:
             self.connectToSchedulerDB()
             if stage == 2:
                AtlasMNSLogger.warning('Failed to query agents: ' + str(e).strip())
-               return []
+               return None
 
       # ====== Provide result as list of dictionaries =======================
       agents = []
@@ -550,8 +1111,182 @@ class AtlasMNS:
          except psycopg2.Error as e:
             self.connectToSchedulerDB()
             if stage == 2:
-               print('Unable to purge agents: ' + str(e).strip())
-               return
+               AtlasMNSLogger.warning('Unable to purge agents: ' + str(e).strip())
+               return False
+
+      return True
+
+
+   # ###### Reap entries of silent agents ###################################
+   # Entries in state agent_scheduled, whose agent has not been seen for
+   # more than the given timeout, are failed or re-queued. The update is
+   # performed in a single transaction; the reaped entries are returned.
+   # An entry is re-queued only once (marked by RequeuedInfoPrefix in its
+   # Info). If its agent is still silent when it is reaped again, it fails,
+   # instead of creating a new (paid) RIPE Atlas measurement every time.
+   def reapStaleEntries(self, seconds = None, requeue = None):
+      if seconds == None:
+         seconds = int(self.configuration['agent_timeout'])
+      if requeue == None:
+         requeue = (self.configuration['agent_timeout_action'] == 'requeue')
+      staleCondition = """
+                  State = 'agent_scheduled' AND
+                  LastChange < (NOW() - INTERVAL %(Interval)s) AND
+                  NOT EXISTS (
+                     SELECT 1 FROM AgentLastSeen
+                     WHERE
+                        AgentLastSeen.AgentHostIP = ExperimentSchedule.AgentHostIP AND
+                        AgentLastSeen.LastSeen >= (NOW() - INTERVAL %(Interval)s)
+                  )"""
+      parameters = {
+         'Interval':        str(str(seconds) + ' SECONDS'),
+         'Info':            'Agent not seen for more than ' + str(seconds) + ' s',
+         'RequeuedInfo':    RequeuedInfoPrefix + 'Agent not seen for more than ' + str(seconds) + ' s',
+         'RequeuedPattern': RequeuedInfoPrefix + '%'
+      }
+
+      for stage in [ 1, 2 ]:
+         try:
+            if self.scheduler_dbCursor == None:
+               raise psycopg2.Error('Disconnected from database')
+            # ====== Fail entries (already re-queued ones, if re-queuing) ===
+            self.scheduler_dbCursor.execute("""
+               UPDATE ExperimentSchedule
+               SET
+                  State = 'failed', LastChange = NOW(), Info = %(Info)s
+               WHERE""" + staleCondition +
+               (""" AND
+                  COALESCE(Info, '') LIKE %(RequeuedPattern)s""" if requeue else "") + """
+               RETURNING Identifier,State,AgentHostIP,ProbeID
+               """, parameters)
+            table = self.scheduler_dbCursor.fetchall()
+            # ====== Re-queue the other entries =============================
+            if requeue:
+               self.scheduler_dbCursor.execute("""
+                  UPDATE ExperimentSchedule
+                  SET
+                     State = 'scheduled', LastChange = NOW(), AgentMeasurementTime = NULL,
+                     ProbeMeasurementID = NULL, ProbeHostIP = NULL, ProbeFromIP = NULL,
+                     ProbeAPIKeyID = NULL, ProbeIntentToken = NULL,
+                     Info = %(RequeuedInfo)s
+                  WHERE""" + staleCondition + """
+                  RETURNING Identifier,State,AgentHostIP,ProbeID
+                  """, parameters)
+               table = table + self.scheduler_dbCursor.fetchall()
+            self.scheduler_dbConnection.commit()
+            break
+         except psycopg2.Error as e:
+            self.connectToSchedulerDB()
+            if stage == 2:
+               AtlasMNSLogger.warning('Failed to reap stale entries: ' + str(e).strip())
+               return []
+
+      # ====== Provide result as list of dictionaries =======================
+      reaped = []
+      for row in table:
+         reaped.append({
+            'Identifier':  row[0],
+            'State':       row[1],
+            'AgentHostIP': row[2],
+            'ProbeID':     row[3]
+         })
+      return reaped
+
+
+   # ###### Journal intent to create RIPE Atlas measurement #################
+   # Before creating the measurement, the entries are set to atlas_creating
+   # with the token, which is also put into the measurement description.
+   # After a crash, the measurement can then be found by the token.
+   # Only entries still in state scheduled are journaled (others may have
+   # been changed in the meantime, e.g. removed by the controller).
+   # Returns the list of journaled entries (which may be empty), or None in
+   # case of error.
+   def journalRIPEAtlasIntent(self, scheduledEntries, token):
+      for stage in [ 1, 2 ]:
+         try:
+            if self.scheduler_dbCursor == None:
+               raise psycopg2.Error('Disconnected from database')
+            self.scheduler_dbCursor.execute("""
+               UPDATE ExperimentSchedule
+               SET
+                  State = 'atlas_creating', LastChange = NOW(), ProbeIntentToken = %(Token)s
+               WHERE
+                  Identifier = ANY(%(Identifiers)s) AND
+                  State = 'scheduled'
+               RETURNING Identifier
+               """, {
+                  'Token':       token,
+                  'Identifiers': [ scheduledEntry['Identifier'] for scheduledEntry in scheduledEntries ]
+               })
+            journaled = set([ row[0] for row in self.scheduler_dbCursor.fetchall() ])
+            self.scheduler_dbConnection.commit()
+            break
+         except psycopg2.Error as e:
+            self.connectToSchedulerDB()
+            if stage == 2:
+               AtlasMNSLogger.warning('Failed to journal intent: ' + str(e).strip())
+               return None
+
+      journaledEntries = [ ]
+      for scheduledEntry in scheduledEntries:
+         if scheduledEntry['Identifier'] in journaled:
+            scheduledEntry['State']            = 'atlas_creating'
+            scheduledEntry['ProbeIntentToken'] = token
+            journaledEntries.append(scheduledEntry)
+         else:
+            AtlasMNSLogger.info('ID #' + str(scheduledEntry['Identifier']) +
+                                ': no longer scheduled -> skipped')
+      return journaledEntries
+
+
+   # ###### Reconcile interrupted RIPE Atlas measurement creation ##########
+   # scheduledEntries are the entries in atlas_creating with the given token.
+   # If a measurement with the token exists, the entries are re-attached to
+   # it (and any further ones are stopped). Otherwise, they are scheduled
+   # again. If the search keeps failing for longer than maxAge, the entries
+   # fail (rescheduling could create a second, paid measurement).
+   def reconcileRIPEAtlasIntent(self, token, scheduledEntries, maxAge):
+      if token != None:
+         measurements = self.findRIPEAtlasMeasurements(token)
+         if measurements == None:
+            created = min([ scheduledEntry['LastChange'] for scheduledEntry in scheduledEntries ])
+            if datetime.datetime.now() - created > maxAge:
+               for scheduledEntry in scheduledEntries:
+                  AtlasMNSLogger.warning('ID #' + str(scheduledEntry['Identifier']) +
+                                         ': unable to find RIPE Atlas measurement for ' + token +
+                                         ' within ' + str(maxAge) + ' -> giving up!')
+                  scheduledEntry['State'] = 'failed'
+                  scheduledEntry['Info']  = 'Unable to find RIPE Atlas measurement for ' + token
+                  self.updateScheduledEntry(scheduledEntry)
+            return   # Otherwise, retry later
+      else:
+         measurements = [ ]
+
+      if len(measurements) > 0:
+         ( measurementID, keyID ) = measurements[0]
+         for ( extraMeasurementID, extraKeyID ) in measurements[1:]:
+            AtlasMNSLogger.warning('Stopping duplicate RIPE Atlas Measurement #' +
+                                   str(extraMeasurementID) + ' for ' + token)
+            self.stopRIPEAtlasMeasurement(extraMeasurementID, extraKeyID)
+         # The measurement has not been charged yet, since its creation has
+         # been interrupted:
+         cost = self.getRIPEAtlasTracerouteCost()
+         self.chargeRIPEAtlasKey(keyID, cost)
+         splitRIPEAtlasCost(scheduledEntries, cost)
+         for scheduledEntry in scheduledEntries:
+            AtlasMNSLogger.info('ID #' + str(scheduledEntry['Identifier']) +
+                                ': re-attaching to RIPE Atlas Measurement #' + str(measurementID))
+            scheduledEntry['State']              = 'atlas_scheduled'
+            scheduledEntry['ProbeMeasurementID'] = measurementID
+            scheduledEntry['ProbeAPIKeyID']      = keyID
+            self.updateScheduledEntry(scheduledEntry)
+      else:
+         for scheduledEntry in scheduledEntries:
+            AtlasMNSLogger.info('ID #' + str(scheduledEntry['Identifier']) +
+                                ': no RIPE Atlas measurement has been created -> rescheduling')
+            scheduledEntry['State']            = 'scheduled'
+            scheduledEntry['ProbeIntentToken'] = None
+            self.updateScheduledEntry(scheduledEntry)
 
 
    # ###### Update schedule in scheduler database ###########################
@@ -565,7 +1300,7 @@ class AtlasMNS:
                """
                UPDATE ExperimentSchedule
                SET
-                  State=%s,LastChange=NOW(),AgentHostIP=%s,AgentTrafficClass=%s, AgentFromIP=%s,ProbeID=%s,ProbeMeasurementID=%s,ProbeCost=%s,ProbeHostIP=%s,ProbeFromIP=%s,Info=%s
+                  State=%s,LastChange=NOW(),AgentHostIP=%s,AgentTrafficClass=%s, AgentFromIP=%s,ProbeID=%s,ProbeMeasurementID=%s,ProbeCost=%s,ProbeHostIP=%s,ProbeFromIP=%s,Info=%s,ProbeAPIKeyID=%s,ProbeIntentToken=%s
                WHERE
                   Identifier = %s;
                """,  [
@@ -579,6 +1314,8 @@ class AtlasMNS:
                   scheduledEntry['ProbeHostIP'],
                   scheduledEntry['ProbeFromIP'],
                   scheduledEntry['Info'],
+                  scheduledEntry['ProbeAPIKeyID'],
+                  scheduledEntry['ProbeIntentToken'],
                   scheduledEntry['Identifier']
                ] )
             self.scheduler_dbConnection.commit()
@@ -608,19 +1345,98 @@ class AtlasMNS:
                                                        port=int(self.configuration['results_dbport']),
                                                        ssl=True, ssl_cert_reqs=ssl.CERT_REQUIRED,
                                                        ssl_ca_certs=self.configuration['results_cafile'])
-         self.results_db = results_dbConnection[str(self.configuration['results_database'])]
-         self.results_db.authenticate(str(self.configuration['results_dbuser']),
-                                      str(self.configuration['results_dbpassword']),
-                                      mechanism='SCRAM-SHA-1')
+         results_db = results_dbConnection[str(self.configuration['results_database'])]
+         results_db.authenticate(str(self.configuration['results_dbuser']),
+                                 str(self.configuration['results_dbpassword']),
+                                 mechanism='SCRAM-SHA-1')
       except Exception as e:
          AtlasMNSLogger.error('Unable to connect to the MongoDB results database at ' +
                               self.configuration['results_dbserver'] + ': ' + str(e))
          return False
 
+      self.results_dbConnection = results_dbConnection
+      self.results_db           = results_db
       return True
 
 
+   # ###### Get MongoDB results database (connect on first use) #############
+   def getResultsDB(self):
+      if self.results_db == None:
+         if not self.connectToResultsDB():
+            return None
+      return self.results_db
+
+
+   # ###### Get results collection name ####################################
+   # With monthly bucketing, results are stored in per-month collections
+   # (e.g. ripeatlastraceroute_2026_10), by agent measurement time. Old data
+   # can then be removed by dropping whole buckets. timeStamp is in
+   # microseconds since the epoch.
+   def getResultsCollectionName(self, baseName, timeStamp):
+      if self.configuration['results_bucketing'] == 'monthly':
+         dt = AtlasMNSTools.timeStampToDatetime(timeStamp)
+         return baseName + '_{0:04d}_{1:02d}'.format(dt.year, dt.month)
+      return baseName
+
+
+   # ###### Route query to results collection ##############################
+   # Returns the bucket for the given time stamp. If it does not exist, the
+   # unbucketed collection is used (e.g. for data imported before enabling
+   # bucketing, or for HiPerConTracer results imported without bucketing).
+   def routeResultsCollection(self, resultsDB, baseName, timeStamp):
+      collectionName = self.getResultsCollectionName(baseName, timeStamp)
+      if ((collectionName != baseName) and
+          (len(resultsDB.list_collection_names(filter = { 'name': collectionName })) == 0)):
+         return baseName
+      return collectionName
+
+
+   # ###### Prepare results bucket ##########################################
+   def prepareResultsBucket(self, resultsDB, collectionName):
+      if not collectionName in self.results_buckets:
+         if len(resultsDB.list_collection_names(filter = { 'name': collectionName })) == 0:
+            AtlasMNSLogger.info('Creating results bucket ' + collectionName + ' ...')
+            resultsDB.create_collection(collectionName,
+               storageEngine = { 'wiredTiger': { 'configString': 'block_compressor=zlib' } })
+         resultsDB[collectionName].create_index([ ('timestamp', 1) ])
+         resultsDB[collectionName].create_index([ ('msm_id', 1) ])
+         self.results_buckets.add(collectionName)
+
+
+   # ###### Drop old results buckets ########################################
+   # Drops the buckets of the months before the given number of months.
+   # At least the current month is kept, i.e. months must be >= 1.
+   # Returns the list of dropped buckets, or None in case of error.
+   def dropResultsBuckets(self, months):
+      if months < 1:
+         AtlasMNSLogger.error('Number of months to keep must be at least 1, not ' + str(months) + '!')
+         return None
+      resultsDB = self.getResultsDB()
+      if resultsDB == None:
+         return None
+
+      now = datetime.datetime.utcnow()
+      firstMonth = (now.year * 12 + now.month - 1) - months
+      dropped = []
+      try:
+         for collectionName in sorted(resultsDB.list_collection_names()):
+            match = re.match(r'^(ripeatlastraceroute|traceroute)_(\d{4})_(\d{2})$', collectionName)
+            if match != None:
+               month = int(match.group(2)) * 12 + int(match.group(3)) - 1
+               if month < firstMonth:
+                  AtlasMNSLogger.info('Dropping results bucket ' + collectionName + ' ...')
+                  resultsDB.drop_collection(collectionName)
+                  self.results_buckets.discard(collectionName)
+                  dropped.append(collectionName)
+      except Exception as e:
+         AtlasMNSLogger.error('Unable to drop results buckets: ' + str(e))
+         return None
+      return dropped
+
+
    # ###### Import results ##################################################
+   # The RIPE Atlas results of a measurement shared by several entries are
+   # only stored once (per collection). The summary is stored per entry.
    def importResults(self, scheduledEntry, results):
       experiment = {
          'timestamp':            AtlasMNSTools.datatimeToTimeStamp(datetime.datetime.utcnow()),   # Ensure microseconds precision!
@@ -635,19 +1451,131 @@ class AtlasMNS:
          'probeHostIP':          scheduledEntry['ProbeHostIP'],
          'probeFromIP':          scheduledEntry['ProbeFromIP']
       }
+      experiment['ripeAtlasCollection'] = self.getResultsCollectionName('ripeatlastraceroute',
+                                                                        experiment['agentMeasurementTime'])
       # print(experiment)
+      if self.configuration['results_ripeatlas_format'] == 'compact':
+         results = [ encodeRIPEAtlasResult(result) for result in results ]
+      resultsDB = self.getResultsDB()
+      if resultsDB == None:
+         return False
       try:
-         self.results_db['ripeatlastraceroute'].insert(results)
-         self.results_db['atlasmns'].insert(experiment)
+         if experiment['ripeAtlasCollection'] != 'ripeatlastraceroute':
+            self.prepareResultsBucket(resultsDB, experiment['ripeAtlasCollection'])
+         ripeAtlasCollection = resultsDB[experiment['ripeAtlasCollection']]
+         if ripeAtlasCollection.find_one({ 'msm_id': scheduledEntry['ProbeMeasurementID'] },
+                                         { '_id': 1 }) == None:
+            ripeAtlasCollection.insert(results)
+         resultsDB['atlasmns'].insert(experiment)
          return True
       except Exception as e:
          AtlasMNSLogger.error('Unable to import results: ' + str(e))
          return False
 
 
+   # ###### Convert stored RIPE Atlas results to compact format ############
+   # Returns the number of converted results, or None in case of error.
+   def compactRIPEAtlasResults(self, batchSize = 1000):
+      resultsDB = self.getResultsDB()
+      if resultsDB == None:
+         return None
+      converted = 0
+      try:
+         for collectionName in sorted(resultsDB.list_collection_names(
+                                        filter = { 'name': { '$regex': '^ripeatlastraceroute' } })):
+            collection = resultsDB[collectionName]
+            requests   = []
+            for result in collection.find( { 'v': { '$exists': False } } ):
+               requests.append(pymongo.ReplaceOne( { '_id': result['_id'] },
+                                                   encodeRIPEAtlasResult(result) ))
+               if len(requests) >= batchSize:
+                  collection.bulk_write(requests, ordered = False)
+                  converted = converted + len(requests)
+                  requests  = []
+                  AtlasMNSLogger.trace('Converted ' + str(converted) + ' RIPE Atlas results ...')
+            if len(requests) > 0:
+               collection.bulk_write(requests, ordered = False)
+               converted = converted + len(requests)
+      except Exception as e:
+         AtlasMNSLogger.error('Unable to convert RIPE Atlas results: ' + str(e))
+         return None
+      return converted
+
+
+   # ###### Update hourly RTT rollup ########################################
+   # Updates the rollup for the hours of the experiments imported within the
+   # given import time ranges, i.e. a list of ( from, to ) time stamps.
+   def updateRTTRollup(self, importRanges):
+      resultsDB = self.getResultsDB()
+      if resultsDB == None:
+         return False
+      try:
+         # $merge needs the unique index on the rollup key:
+         if not self.rollup_indexReady:
+            AtlasMNSRollup.ensureRollupIndex(resultsDB)
+            self.rollup_indexReady = True
+         hours = set()
+         for fromImportTime, toImportTime in importRanges:
+            hours = hours | AtlasMNSRollup.getImportedHours(resultsDB, fromImportTime, toImportTime)
+         AtlasMNSLogger.trace('Updating RTT rollup for ' + str(len(hours)) + ' hours ...')
+         AtlasMNSRollup.updateRollupForHours(resultsDB, hours,
+                                             lambda baseName, timeStamp: self.routeResultsCollection(resultsDB, baseName, timeStamp))
+      except Exception as e:
+         AtlasMNSLogger.error('Unable to update RTT rollup: ' + str(e))
+         return False
+      return True
+
+
+   # ###### Rebuild hourly RTT rollup #######################################
+   # Rebuilds the rollup day by day, for the experiments of the last given
+   # hours, or for all experiments (backfill).
+   def rebuildRTTRollup(self, hours = None):
+      resultsDB = self.getResultsDB()
+      if resultsDB == None:
+         return False
+      now = AtlasMNSTools.datatimeToTimeStamp(datetime.datetime.utcnow())
+      try:
+         AtlasMNSRollup.ensureRollupIndex(resultsDB)
+         self.rollup_indexReady = True
+         if hours != None:
+            fromTimeStamp = now - hours * AtlasMNSRollup.HourInMicroseconds
+         else:
+            first = resultsDB['atlasmns'].find_one({ }, sort = [ ('agentMeasurementTime', 1) ])
+            if first == None:
+               return True
+            fromTimeStamp = first['agentMeasurementTime']
+
+         step = 24 * AtlasMNSRollup.HourInMicroseconds
+         while fromTimeStamp < now:
+            AtlasMNSLogger.info('Rebuilding RTT rollup from ' +
+                                str(AtlasMNSTools.timeStampToDatetime(fromTimeStamp)) + ' ...')
+            AtlasMNSRollup.updateRollup(resultsDB, fromTimeStamp, min(fromTimeStamp + step, now),
+                                        lambda baseName, timeStamp: self.routeResultsCollection(resultsDB, baseName, timeStamp))
+            fromTimeStamp = fromTimeStamp + step
+      except Exception as e:
+         AtlasMNSLogger.error('Unable to rebuild RTT rollup: ' + str(e))
+         return False
+      return True
+
+
+   # ###### Query hourly RTT rollup #########################################
+   def queryRTTRollup(self, agentHostIP, probeID, hours = 24):
+      resultsDB = self.getResultsDB()
+      if resultsDB == None:
+         return None
+      now = AtlasMNSTools.datatimeToTimeStamp(datetime.datetime.utcnow())
+      try:
+         return AtlasMNSRollup.queryRollup(resultsDB, agentHostIP, probeID,
+                                           now - hours * AtlasMNSRollup.HourInMicroseconds)
+      except Exception as e:
+         AtlasMNSLogger.error('Unable to query RTT rollup: ' + str(e))
+         return None
+
+
    # ###### Dump RIPE Atlas result ##########################################
    def dumpRIPEAtlasResult(self, result):
       # print(result)
+      result = decodeRIPEAtlasResult(result)
       try:
          print('Probe #' + str(result['prb_id']) + ': ' +
                result['src_addr'] + ' (' + result['from'] + ') -> ' + result['dst_addr'])
@@ -688,15 +1616,18 @@ class AtlasMNS:
 
    # ###### Query results ###################################################
    def queryResults(self, identifier):
+      resultsDB = self.getResultsDB()
+      if resultsDB == None:
+         return [ False, None, None, None ]
       try:
          # ====== Find experiment ==============================================
-         experiments = self.results_db['atlasmns'].find( { 'identifier': { '$eq': identifier }} )
+         experiments = resultsDB['atlasmns'].find( { 'identifier': { '$eq': identifier }} )
          myExperiment = None
          for experiment in experiments:
             if myExperiment == None:
                myExperiment = experiment
             else:
-               print('WARNING: Multiple experiments found! Something is wrong!')
+               AtlasMNSLogger.warning('Multiple experiments found! Something is wrong!')
                myExperiment = experiment
          if myExperiment == None:
             return [ False, None, None, None ]
@@ -705,10 +1636,15 @@ class AtlasMNS:
          myAgentMeasurementTime = myExperiment['agentMeasurementTime']
 
          # ====== Find RIPE Atlas results =======================================
-         ripeAtlasResults = self.results_db['ripeatlastraceroute'].find( { 'msm_id': { '$eq': myProbeMeasurementID }} )
+         # NOTE: Experiments imported before bucketing support have no
+         #       ripeAtlasCollection entry; their results are unbucketed.
+         ripeAtlasCollection = myExperiment.get('ripeAtlasCollection', 'ripeatlastraceroute')
+         ripeAtlasResults = map(decodeRIPEAtlasResult,
+                                resultsDB[ripeAtlasCollection].find( { 'msm_id': { '$eq': myProbeMeasurementID }} ))
 
          # ====== Find HiPerConTracer results ===================================
-         hiPerConTracerResults = self.results_db['traceroute'].find( { 'timestamp': { '$eq': myAgentMeasurementTime }} )
+         hiPerConTracerCollection = self.routeResultsCollection(resultsDB, 'traceroute', myAgentMeasurementTime)
+         hiPerConTracerResults = resultsDB[hiPerConTracerCollection].find( { 'timestamp': { '$eq': myAgentMeasurementTime }} )
 
          return [ True, myExperiment, ripeAtlasResults, hiPerConTracerResults ]
 
@@ -130,7 +130,7 @@ class AtlasMNSLogger:
             },
          },
          'root': {
-            'level': 'TRACE',
+            'level': logLevel,
             'handlers': ['default'],
          }
       }
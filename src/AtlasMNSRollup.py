@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  =================================================================
+#           #     #                 #     #
+#           ##    #   ####   #####  ##    #  ######   #####
+#           # #   #  #    #  #    # # #   #  #          #
+#           #  #  #  #    #  #    # #  #  #  #####      #
+#           #   # #  #    #  #####  #   # #  #          #
+#           #    ##  #    #  #   #  #    ##  #          #
+#           #     #   ####   #    # #     #  ######     #
+#
+#        ---   The NorNet Testbed for Multi-Homed Systems  ---
+#                        https://www.nntb.no
+#  =================================================================
+#
+#  High-Performance Connectivity Tracer (HiPerConTracer)
+#  Copyright (C) 2015-2021 by Thomas Dreibholz
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Contact: dreibh@simula.no
+
+
+
+import AtlasMNSLogger
+import AtlasMNSTools
+
+
+# Hourly RTT statistics per (agent, probe, traffic class, direction) are
+# kept in the rollup collection. The statistics of an hour are computed by
+# aggregation pipelines from all experiments of the hour (by agent
+# measurement time), and merged into the rollup collection. So, an update
+# only has to process the experiments of the hours to be updated.
+#
+# Directions:
+# - probe-to-agent: RIPE Atlas traceroute from the probe to the agent
+# - agent-to-probe: HiPerConTracer traceroute from the agent to the probe
+
+RollupCollection      = 'rtthourly'
+RollupKey             = [ 'agentHostIP', 'probeID', 'agentTrafficClass', 'direction', 'hour' ]
+HourInMicroseconds    = 3600 * 1000000
+HiPerConTracerSuccess = 255   # Hop status for reply from destination
+
+
+# ###### Make grouping key expression #######################################
+def makeKeyExpression():
+   return {
+      'agentHostIP':       '$agentHostIP',
+      'agentTrafficClass': '$agentTrafficClass',
+      'probeID':           '$probeID',
+      'hour':              { '$subtract': [ '$agentMeasurementTime',
+                                            { '$mod': [ '$agentMeasurementTime', HourInMicroseconds ] } ] }
+   }
+
+
+# ###### Make percentile expression for sorted RTTs array ###################
+def makePercentileExpression(q):
+   return { '$arrayElemAt': [
+               '$rtts',
+               { '$toInt': { '$floor': { '$multiply': [ { '$subtract': [ { '$size': '$rtts' }, 1 ] }, q ] } } }
+            ] }
+
+
+# ###### Make statistics stages #############################################
+# Input: documents with key, rtt (in ms, None for loss) and hops.
+def makeStatisticsStages(direction):
+   return [
+      { '$sort': { 'rtt': 1 } },
+      { '$group': {
+         '_id':   '$key',
+         'count': { '$sum': 1 },
+         'hops':  { '$avg': '$hops' },
+         'rtts':  { '$push': '$rtt' }
+      } },
+      { '$project': {
+         'count': 1,
+         'hops':  1,
+         'rtts':  { '$filter': { 'input': '$rtts', 'as': 'rtt', 'cond': { '$ne': [ '$$rtt', None ] } } }
+      } },
+      { '$project': {
+         '_id':               0,
+         'agentHostIP':       '$_id.agentHostIP',
+         'probeID':           '$_id.probeID',
+         'agentTrafficClass': '$_id.agentTrafficClass',
+         'direction':         { '$literal': direction },
+         'hour':              '$_id.hour',
+         'count':             1,
+         'loss':              { '$subtract': [ 1, { '$divide': [ { '$size': '$rtts' }, '$count' ] } ] },
+         'rttMin':            makePercentileExpression(0.0),
+         'rttMedian':         makePercentileExpression(0.5),
+         'rttP95':            makePercentileExpression(0.95),
+         'rttMax':            makePercentileExpression(1.0),
+         'hopCount':          '$hops'
+      } },
+      { '$merge': {
+         'into':           RollupCollection,
+         'on':             RollupKey,
+         'whenMatched':    'replace',
+         'whenNotMatched': 'insert'
+      } }
+   ]
+
+
+# ###### Make pipeline for RIPE Atlas results ###############################
+def makeRIPEAtlasPipeline(fromTimeStamp, toTimeStamp, collectionName = 'ripeatlastraceroute'):
+   return [
+      { '$match': { 'agentMeasurementTime': { '$gte': fromTimeStamp, '$lt': toTimeStamp } } },
+      { '$lookup': {
+         'from':         collectionName,
+         'localField':   'probeMeasurementID',
+         'foreignField': 'msm_id',
+         'as':           'sample'
+      } },
+      { '$unwind': '$sample' },
+      # Results may be stored in JSON or compact format (see AtlasMNS.py):
+      { '$project': {
+         'key':     makeKeyExpression(),
+         'compact': { '$eq': [ '$sample.v', 1 ] },
+         'dst':     { '$ifNull': [ '$sample.d', '$sample.dst_addr' ] },
+         'lastHop': { '$arrayElemAt': [ { '$ifNull': [ '$sample.h', '$sample.result' ] }, -1 ] }
+      } },
+      { '$project': {
+         'key':  1,
+         'hops': { '$cond': [ '$compact',
+                              { '$arrayElemAt': [ '$lastHop', 0 ] },
+                              '$lastHop.hop' ] },
+         'rtt':  { '$cond': [ '$compact',
+                              { '$divide': [ { '$min': { '$map': {
+                                 'input': { '$filter': { 'input': { '$ifNull': [ { '$arrayElemAt': [ '$lastHop', 1 ] }, [] ] },
+                                                         'as':    'reply',
+                                                         'cond':  { '$eq': [ { '$arrayElemAt': [ '$$reply', 0 ] }, '$dst' ] } } },
+                                 'as':    'reply',
+                                 'in':    { '$arrayElemAt': [ '$$reply', 1 ] } } } },
+                                 1000.0 ] },   # Note: compact RTT is in microseconds!
+                              { '$min': { '$map': {
+                                 'input': { '$filter': { 'input': { '$ifNull': [ '$lastHop.result', [] ] },
+                                                         'as':    'reply',
+                                                         'cond':  { '$eq': [ '$$reply.from', '$dst' ] } } },
+                                 'as':    'reply',
+                                 'in':    '$$reply.rtt' } } } ] }
+      } }
+   ] + makeStatisticsStages('probe-to-agent')
+
+
+# ###### Make pipeline for HiPerConTracer results ###########################
+def makeHiPerConTracerPipeline(fromTimeStamp, toTimeStamp, collectionName = 'traceroute'):
+   return [
+      { '$match': { 'agentMeasurementTime': { '$gte': fromTimeStamp, '$lt': toTimeStamp } } },
+      { '$lookup': {
+         'from':         collectionName,
+         'localField':   'agentMeasurementTime',
+         'foreignField': 'timestamp',
+         'as':           'sample'
+      } },
+      { '$unwind': '$sample' },
+      { '$project': {
+         'key':     makeKeyExpression(),
+         'hops':    { '$size': '$sample.hops' },
+         'lastHop': { '$arrayElemAt': [ '$sample.hops', -1 ] }
+      } },
+      { '$project': {
+         'key':  1,
+         'hops': 1,
+         'rtt':  { '$cond': [ { '$eq': [ '$lastHop.status', HiPerConTracerSuccess ] },
+                              { '$divide': [ '$lastHop.rtt', 1000.0 ] },   # Note: stored RTT is in microseconds!
+                              None ] }
+      } }
+   ] + makeStatisticsStages('agent-to-probe')
+
+
+# ###### Ensure index on rollup collection ##################################
+def ensureRollupIndex(resultsDB):
+   resultsDB[RollupCollection].create_index([ (key, 1) for key in RollupKey ], unique = True)
+
+
+# ###### Update rollup for given time range #################################
+# The time range (in microseconds since the epoch) is extended to full hours.
+# routeCollection(baseName, timeStamp) optionally provides the results
+# collection (i.e. the monthly bucket) for the given time stamp.
+def updateRollup(resultsDB, fromTimeStamp, toTimeStamp, routeCollection = None):
+   fromTimeStamp = fromTimeStamp - (fromTimeStamp % HourInMicroseconds)
+   if toTimeStamp % HourInMicroseconds != 0:
+      toTimeStamp = toTimeStamp - (toTimeStamp % HourInMicroseconds) + HourInMicroseconds
+
+   AtlasMNSLogger.trace('Updating RTT rollup ...')
+   while fromTimeStamp < toTimeStamp:
+      # ====== Process time range month by month ============================
+      monthEnd = AtlasMNSTools.datatimeToTimeStamp(
+                    AtlasMNSTools.beginOfNextMonth(AtlasMNSTools.timeStampToDatetime(fromTimeStamp)))
+      chunkEnd = min(toTimeStamp, monthEnd)
+      ripeAtlasCollection      = 'ripeatlastraceroute'
+      hiPerConTracerCollection = 'traceroute'
+      if routeCollection != None:
+         ripeAtlasCollection      = routeCollection(ripeAtlasCollection, fromTimeStamp)
+         hiPerConTracerCollection = routeCollection(hiPerConTracerCollection, fromTimeStamp)
+
+      for pipeline in [ makeRIPEAtlasPipeline(fromTimeStamp, chunkEnd, ripeAtlasCollection),
+                        makeHiPerConTracerPipeline(fromTimeStamp, chunkEnd, hiPerConTracerCollection) ]:
+         resultsDB['atlasmns'].aggregate(pipeline, allowDiskUse = True)
+      fromTimeStamp = chunkEnd
+
+
+# ###### Get hours of experiments imported within given time range ##########
+# The import time range refers to the atlasmns timestamp (i.e. the time of
+# the import), the hours to the agent measurement time.
+def getImportedHours(resultsDB, fromImportTime, toImportTime):
+   hours = resultsDB['atlasmns'].aggregate([
+      { '$match': { 'timestamp': { '$gte': fromImportTime, '$lt': toImportTime } } },
+      { '$group': { '_id': makeKeyExpression()['hour'] } }
+   ])
+   return set([ hour['_id'] for hour in hours if hour['_id'] != None ])
+
+
+# ###### Update rollup for given hours ######################################
+# Consecutive hours are updated together.
+def updateRollupForHours(resultsDB, hours, routeCollection = None):
+   ranges = [ ]
+   for hour in sorted(hours):
+      if (len(ranges) > 0) and (ranges[-1][1] == hour):
+         ranges[-1][1] = hour + HourInMicroseconds
+      else:
+         ranges.append([ hour, hour + HourInMicroseconds ])
+   for fromTimeStamp, toTimeStamp in ranges:
+      updateRollup(resultsDB, fromTimeStamp, toTimeStamp, routeCollection)
+
+
+# ###### Query rollup #######################################################
+def queryRollup(resultsDB, agentHostIP, probeID, fromTimeStamp):
+   return resultsDB[RollupCollection].find(
+             { 'agentHostIP': str(agentHostIP),
+               'probeID':     int(probeID),
+               'hour':        { '$gte': fromTimeStamp - (fromTimeStamp % HourInMicroseconds) } },
+             { '_id': 0 }
+          ).sort([ ('hour', 1), ('agentTrafficClass', 1), ('direction', 1) ])
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+#
+#  =================================================================
+#           #     #                 #     #
+#           ##    #   ####   #####  ##    #  ######   #####
+#           # #   #  #    #  #    # # #   #  #          #
+#           #  #  #  #    #  #    # #  #  #  #####      #
+#           #   # #  #    #  #####  #   # #  #          #
+#           #    ##  #    #  #   #  #    ##  #          #
+#           #     #   ####   #    # #     #  ######     #
+#
+#        ---   The NorNet Testbed for Multi-Homed Systems  ---
+#                        https://www.nntb.no
+#  =================================================================
+#
+#  High-Performance Connectivity Tracer (HiPerConTracer)
+#  Copyright (C) 2015-2021 by Thomas Dreibholz
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#  Contact: dreibh@simula.no
+
+import datetime
+import json
+import os
+import socket
+import socketserver
+import threading
+
+import AtlasMNSLogger
+
+
+# The scheduler already has the schedule and the agents in memory. After
+# each pass, it makes a status snapshot from them, which is served
+# read-only on a Unix socket. A client connects, reads the snapshot as
+# JSON document until the server closes the connection, and is done.
+# So, monitoring clients do not need to query the scheduler database.
+#
+# Snapshot:
+# { 'updated':   <time of snapshot>,
+#   'states':    { <state>: <number of entries>, ... },
+#   'in_flight': [ { <schedule entry fields> }, ... ],
+#   'agents':    [ { 'AgentHostIP', 'AgentHostName', 'LastSeen', 'Location',
+#                    'Backlog': { <state>: <number of entries>, ... } }, ... ] }
+# Until the scheduler has completed its first pass, 'updated' is None (see
+# EmptySnapshot), i.e. there is no snapshot yet.
+
+InFlightStates = [ 'atlas_creating', 'atlas_scheduled', 'agent_scheduled', 'agent_completed' ]
+BacklogStates  = [ 'scheduled' ] + InFlightStates
+InFlightFields = [ 'Identifier', 'State', 'LastChange', 'AgentHostIP',
+                   'AgentTrafficClass', 'AgentFromIP', 'ProbeID',
+                   'ProbeMeasurementID', 'ProbeAPIKeyID' ]
+EmptySnapshot  = { 'updated': None, 'states': { }, 'in_flight': [ ], 'agents': [ ] }
+
+
+# ###### Status collector ###################################################
+# Collects the schedule entries while the scheduler streams the schedule.
+# Entries in final states are only counted. References to the other
+# entries are kept, since the scheduler may still update them in the pass.
+class StatusCollector:
+
+   # ###### Constructor #####################################################
+   def __init__(self):
+      self.finalStates = { }
+      self.entries     = [ ]
+
+
+   # ###### Add schedule entry ##############################################
+   def add(self, scheduledEntry):
+      state = scheduledEntry['State']
+      if state in BacklogStates:
+         self.entries.append(scheduledEntry)
+      else:
+         self.finalStates[state] = self.finalStates.get(state, 0) + 1
+
+
+   # ###### Make status snapshot ############################################
+   def makeSnapshot(self, agents):
+      return makeSnapshot(self.entries, agents, dict(self.finalStates))
+
+
+# ###### Make status snapshot from schedule and agents ######################
+def makeSnapshot(schedule, agents, states = None):
+   if states == None:
+      states = { }
+   inFlight = [ ]
+   backlogs = { }
+   for scheduledEntry in schedule:
+      state = scheduledEntry['State']
+      states[state] = states.get(state, 0) + 1
+      if state in InFlightStates:
+         inFlight.append({ field: scheduledEntry[field] for field in InFlightFields })
+      if state in BacklogStates:
+         backlog = backlogs.setdefault(str(scheduledEntry['AgentHostIP']), { })
+         backlog[state] = backlog.get(state, 0) + 1
+
+   # ====== Per-agent backlog and last-seen time ============================
+   agentList = [ ]
+   for agent in agents:
+      agentList.append({
+         'AgentHostIP':   agent['AgentHostIP'],
+         'AgentHostName': agent['AgentHostName'],
+         'LastSeen':      agent['LastSeen'],
+         'Location':      agent['Location'],
+         'Backlog':       backlogs.pop(str(agent['AgentHostIP']), { })
+      })
+   # Agents having a backlog, but never having been seen:
+   for agentHostIP in sorted(backlogs.keys()):
+      agentList.append({
+         'AgentHostIP':   agentHostIP,
+         'AgentHostName': None,
+         'LastSeen':      None,
+         'Location':      None,
+         'Backlog':       backlogs[agentHostIP]
+      })
+
+   return {
+      'updated':   datetime.datetime.now(),
+      'states':    states,
+      'in_flight': inFlight,
+      'agents':    agentList
+   }
+
+
+# ###### Status request handler #############################################
+class StatusRequestHandler(socketserver.BaseRequestHandler):
+   def handle(self):
+      try:
+         self.request.sendall(self.server.snapshot)
+      except OSError:
+         pass   # Client has gone
+
+
+# ###### Status server ######################################################
+class StatusServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+   daemon_threads = True
+
+   # ###### Constructor #####################################################
+   def __init__(self, socketPath):
+      self.socketPath = socketPath
+      self.snapshot   = json.dumps(EmptySnapshot).encode('utf-8')
+      if os.path.exists(socketPath):
+         os.unlink(socketPath)   # Remove stale socket
+      socketserver.UnixStreamServer.__init__(self, socketPath, StatusRequestHandler)
+      self.thread = threading.Thread(target = self.serve_forever, daemon = True)
+      self.thread.start()
+      AtlasMNSLogger.info('Serving status on ' + socketPath)
+
+
+   # ###### Update snapshot #################################################
+   # The snapshot is serialised once here, and replaced atomically. So,
+   # handlers never see a partially updated snapshot.
+   def update(self, statusCollector, agents):
+      self.snapshot = json.dumps(statusCollector.makeSnapshot(agents), default=str).encode('utf-8')
+
+
+   # ###### Stop server #####################################################
+   def stop(self):
+      self.shutdown()
+      self.server_close()
+      try:
+         os.unlink(self.socketPath)
+      except OSError:
+         pass
+
+
+# ###### Query status from scheduler ########################################
+# Returns the snapshot (with time stamps as strings), or None on error or
+# if there is no snapshot yet.
+def queryStatus(socketPath, timeout = 10.0):
+   try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as statusSocket:
+         statusSocket.settimeout(timeout)
+         statusSocket.connect(socketPath)
+         chunks = [ ]
+         while True:
+            chunk = statusSocket.recv(65536)
+            if len(chunk) == 0:
+               break
+            chunks.append(chunk)
+      status = json.loads(b''.join(chunks).decode('utf-8'))
+   except (OSError, ValueError) as e:
+      AtlasMNSLogger.warning('Unable to query status from ' + socketPath + ': ' + str(e))
+      return None
+
+   if ((not isinstance(status, dict)) or (status.get('updated') == None)):
+      AtlasMNSLogger.warning('No status from ' + socketPath +
+                             ' yet (scheduler has not completed a pass)')
+      return None
+   return status
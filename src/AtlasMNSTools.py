@@ -34,6 +34,7 @@
 
 
 import datetime
+import importlib
 import ipaddress
 
 
@@ -54,6 +55,13 @@ def datatimeToTimeStamp(dt):
    return ts
 
 
+# ###### Get beginning of the month following the given datetime ###########
+def beginOfNextMonth(dt):
+   if dt.month == 12:
+      return datetime.datetime(dt.year + 1, 1, 1)
+   return datetime.datetime(dt.year, dt.month + 1, 1)
+
+
 # ###### Convert IP address to binary #######################################
 def ipAddressToBinary(address):
    return address.packed
@@ -70,3 +78,15 @@ def valueOrNoneString(value):
       return str(value)
    else:
       return ''
+
+
+# ###### Module proxy, importing the actual module on first use #############
+class LazyModule:
+   def __init__(self, moduleName):
+      self.moduleName = moduleName
+      self.module     = None
+
+   def __getattr__(self, name):
+      if self.module == None:
+         self.module = importlib.import_module(self.moduleName)
+      return getattr(self.module, name)
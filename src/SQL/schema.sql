@@ -37,7 +37,14 @@
 CREATE TYPE AtlasMNSStatus AS ENUM (
    'scheduled',
    --  The experiment is scheduled, but no RIPE Atlas measurement created.
-   -- Next state: atlas_scheduled.
+   -- Next state: atlas_creating.
+
+   'atlas_creating',
+   -- The RIPE Atlas measurement is being created. ProbeIntentToken is set
+   -- to a token, which is also in the description of the measurement.
+   -- If the scheduler finds an entry in this state, the creation has been
+   -- interrupted: the measurement is looked up by the token.
+   -- Next state: atlas_scheduled OR scheduled (retry) OR failed.
 
    'atlas_scheduled',
    -- A RIPE Atlas measurement is created. MeasurementID is set to the
@@ -85,13 +92,51 @@ CREATE TABLE ExperimentSchedule (
 
    Info                 VARCHAR          DEFAULT NULL,
 
+   ProbeAPIKeyID        CHAR(16)         DEFAULT NULL,
+   -- ID of the RIPE Atlas API key used for the measurement (the first 16
+   -- hex digits of its SHA-256 hash; the key itself is not stored).
+   -- Existing databases can be upgraded by:
+   -- ALTER TABLE ExperimentSchedule ADD COLUMN ProbeAPIKeyID CHAR(16) DEFAULT NULL;
+
+   ProbeIntentToken     CHAR(32)         DEFAULT NULL,
+   -- Token of the RIPE Atlas measurement creation (see 'atlas_creating').
+   -- Existing databases can be upgraded by:
+   -- ALTER TYPE AtlasMNSStatus ADD VALUE 'atlas_creating' AFTER 'scheduled';
+   -- ALTER TABLE ExperimentSchedule ADD COLUMN ProbeIntentToken CHAR(32) DEFAULT NULL;
+
    PRIMARY KEY (Identifier)
-   -- UNIQUE (AgentHostIP,AgentTrafficClass,AgentFromIP,ProbeID)
+   -- NOTE: Pending runs are unique, see ExperimentSchedule_PendingRun_Index!
 );
 
 DROP INDEX IF EXISTS ExperimentSchedule_LastChange_Index;
 CREATE INDEX ExperimentSchedule_LastChange_Index ON ExperimentSchedule ( LastChange );
 
+DROP INDEX IF EXISTS ExperimentSchedule_State_Index;
+CREATE INDEX ExperimentSchedule_State_Index ON ExperimentSchedule ( State, AgentHostIP, LastChange );
+
+DROP INDEX IF EXISTS ExperimentSchedule_Run_Index;
+CREATE INDEX ExperimentSchedule_Run_Index ON ExperimentSchedule ( AgentHostIP, AgentTrafficClass, AgentFromIP, ProbeID );
+
+-- A run may only be pending once. Failed or finished runs may be repeated.
+-- Existing databases can be upgraded by first removing duplicate pending
+-- runs (keeping, for each run, the entry furthest in its experiment, or
+-- the oldest one), then creating the index:
+-- DELETE FROM ExperimentSchedule WHERE Identifier IN (
+--    SELECT Identifier FROM (
+--       SELECT Identifier, ROW_NUMBER() OVER (
+--          PARTITION BY AgentHostIP, AgentTrafficClass, AgentFromIP, ProbeID
+--          ORDER BY State DESC, Identifier ASC) AS Rank
+--       FROM ExperimentSchedule
+--       WHERE State NOT IN ('failed', 'finished')) AS PendingRuns
+--    WHERE Rank > 1);
+-- DROP INDEX IF EXISTS ExperimentSchedule_Run_Index;
+-- CREATE INDEX ExperimentSchedule_Run_Index ON ExperimentSchedule ( AgentHostIP, AgentTrafficClass, AgentFromIP, ProbeID );
+-- CREATE UNIQUE INDEX ExperimentSchedule_PendingRun_Index ON ExperimentSchedule ( AgentHostIP, AgentTrafficClass, AgentFromIP, ProbeID )
+--    WHERE State NOT IN ('failed', 'finished');
+DROP INDEX IF EXISTS ExperimentSchedule_PendingRun_Index;
+CREATE UNIQUE INDEX ExperimentSchedule_PendingRun_Index ON ExperimentSchedule ( AgentHostIP, AgentTrafficClass, AgentFromIP, ProbeID )
+   WHERE State NOT IN ('failed', 'finished');
+
 
 -- ###### Agent Last Seen ###################################################
 DROP TABLE IF EXISTS AgentLastSeen;
@@ -29,6 +29,7 @@
 //
 // Contact: dreibh@simula.no
 
+#include <atomic>
 #include <fstream>
 #include <functional>
 #include <iostream>
@@ -67,6 +68,8 @@ static std::mutex                                                Mutex;
 static std::chrono::system_clock::time_point                     PreviousLastSeenUpdate(TimeStampNull);
 static const std::chrono::seconds                                AvgLastSeenUpdateInterval(3600);
 static std::chrono::seconds                                      LastSeenUpdateInterval = randomiseInterval(AvgLastSeenUpdateInterval, 0.50);
+static std::atomic<bool>                                         CompletionFlushPending(false);
+static bool                                                      ShuttingDown = false;
 
 
 // ###### Signal handler ####################################################
@@ -101,6 +104,7 @@ static void tryCleanup(const boost::system::error_code& errorCode)
          CleanupTimer.async_wait(tryCleanup);
       }
       else {
+         ShuttingDown = true;
          Signals.cancel();
          ScheduleCheckTimer.cancel();
       }
@@ -111,12 +115,19 @@ static void tryCleanup(const boost::system::error_code& errorCode)
 // ###### Update Last Seen entry ############################################
 static void updateLastSeen(pqxx::work& schedulerDBTransaction)
 {
+   // ====== Update all source addresses in one statement ===================
+   std::string valuesString;
    for(std::set<boost::asio::ip::address>::const_iterator sourceArrayIterator = SourceAddressArray.begin();
       sourceArrayIterator != SourceAddressArray.end(); sourceArrayIterator++) {
       const boost::asio::ip::address& sourceAddress = *sourceArrayIterator;
+      valuesString = valuesString +
+         ((sourceArrayIterator == SourceAddressArray.begin()) ? "(" : ", (") +
+         schedulerDBTransaction.quote(sourceAddress.to_string()) + ", " + schedulerDBTransaction.quote(HostName) + ")";
+   }
+   if(!valuesString.empty()) {
       schedulerDBTransaction.exec(
          "INSERT INTO AgentLastSeen (AgentHostIP,AgentHostName) "
-         "VALUES (" + schedulerDBTransaction.quote(sourceAddress.to_string()) + ", " + schedulerDBTransaction.quote(HostName) + ") "
+         "VALUES " + valuesString + " "
          "ON CONFLICT (AgentHostIP,AgentHostName) DO UPDATE "
          "SET LastSeen = NOW()"
       );
@@ -125,6 +136,95 @@ static void updateLastSeen(pqxx::work& schedulerDBTransaction)
 }
 
 
+// ###### Update completed measurements #####################################
+// All completed measurements are updated in one statement. Entries which
+// are no longer agent_scheduled (e.g. reaped by the scheduler) are left
+// unchanged. The returned identifiers have to be removed from TimeStampSet
+// after the transaction has been committed.
+static std::vector<uint32_t> updateCompletions(pqxx::work& schedulerDBTransaction)
+{
+   // ====== Collect completed measurements =================================
+   std::vector<std::pair<uint32_t, std::chrono::system_clock::time_point>> completions;
+   {
+      std::lock_guard<std::mutex> lock(Mutex);
+      for(std::map<uint32_t, std::chrono::system_clock::time_point>::const_iterator iterator = TimeStampSet.begin();
+          iterator != TimeStampSet.end(); iterator++) {
+         if(iterator->second > TimeStampNull) {
+            completions.push_back(*iterator);
+         }
+      }
+   }
+   // NOTE: The mutex is unlocked now, to prevent blocking during database processing!
+
+   // ====== Update scheduled entries =======================================
+   std::vector<uint32_t> identifiers;
+   if(!completions.empty()) {
+      std::string valuesString;
+      for(std::vector<std::pair<uint32_t, std::chrono::system_clock::time_point>>::const_iterator iterator = completions.begin();
+          iterator != completions.end(); iterator++) {
+         // std::cout << iterator->first << " -> " << usSinceEpoch(iterator->second) << std::endl;
+         valuesString = valuesString +
+            ((iterator == completions.begin()) ? "(" : ", (") +
+            schedulerDBTransaction.quote(iterator->first) + "::INTEGER, " +
+            schedulerDBTransaction.quote(timePointToStringUTC(iterator->second)) + "::TIMESTAMP)";
+         identifiers.push_back(iterator->first);
+      }
+
+      HPCT_LOG(trace) << "Updating " << completions.size() << " scheduled entries ...";
+      schedulerDBTransaction.exec(
+         "UPDATE ExperimentSchedule "
+         "SET "
+            "State = 'agent_completed',"
+            "AgentMeasurementTime = Completed.SendTime "
+         "FROM (VALUES " + valuesString + ") AS Completed(Identifier, SendTime) "
+         "WHERE "
+            "ExperimentSchedule.Identifier = Completed.Identifier AND "
+            "ExperimentSchedule.State = 'agent_scheduled'"
+      );
+   }
+   return identifiers;
+}
+
+
+// ###### Remove committed completions from TimeStampSet ###################
+static void removeCompletions(const std::vector<uint32_t>& identifiers)
+{
+   std::lock_guard<std::mutex> lock(Mutex);
+   for(std::vector<uint32_t>::const_iterator iterator = identifiers.begin();
+       iterator != identifiers.end(); iterator++) {
+      TimeStampSet.erase(*iterator);
+   }
+}
+
+
+// ###### Flush completed measurements ######################################
+// Posted by resultCallback(), to update completed measurements immediately
+// instead of waiting for the next schedule check. Also called once after
+// the main loop has finished, to write the last completions.
+// NOTE: A flush does not re-arm any timer, i.e. a flush still pending
+//       during shutdown does not prevent IOService.run() from returning.
+static void flushCompletions(pqxx::connection* schedulerDBConnection)
+{
+   // Results arriving from now on need a new flush:
+   CompletionFlushPending = false;
+
+   try {
+      pqxx::work schedulerDBTransaction(*schedulerDBConnection);
+      const std::vector<uint32_t> identifiers = updateCompletions(schedulerDBTransaction);
+      if(!identifiers.empty()) {
+         updateLastSeen(schedulerDBTransaction);
+      }
+      schedulerDBTransaction.commit();
+      removeCompletions(identifiers);
+   }
+   catch (const std::exception &e) {
+      // The completions remain in TimeStampSet, i.e. the next schedule
+      // check will retry.
+      HPCT_LOG(warning) << "Unable to communicate with scheduler database: " << e.what();
+   }
+}
+
+
 // ###### Check schedule ####################################################
 static void checkSchedule(const boost::system::error_code& errorCode,
                           pqxx::connection*                schedulerDBConnection)
@@ -134,6 +234,7 @@ static void checkSchedule(const boost::system::error_code& errorCode,
       bool updated = false;
 
       try {
+         std::vector<uint32_t> completedIdentifiers;
          // ====== Query scheduled measurements =============================
          pqxx::work schedulerDBTransaction(*schedulerDBConnection);
          std::string allSourcesString = "( ";
@@ -153,6 +254,11 @@ static void checkSchedule(const boost::system::error_code& errorCode,
             updateLastSeen(schedulerDBTransaction);
             LastSeenUpdateInterval = randomiseInterval(AvgLastSeenUpdateInterval, 0.50);
          }
+         // Completions not yet flushed (e.g. after a database failure):
+         completedIdentifiers = updateCompletions(schedulerDBTransaction);
+         if(!completedIdentifiers.empty()) {
+            updated = true;
+         }
          pqxx::result result = schedulerDBTransaction.exec(
             "SELECT Identifier, AgentHostIP, AgentTrafficClass, ProbeFromIP "
             "FROM ExperimentSchedule "
@@ -189,28 +295,8 @@ static void checkSchedule(const boost::system::error_code& errorCode,
 
             // ====== Traceroute to destination already scheduled ===========
             else {
-               if(found->second > TimeStampNull) {
-                  const std::chrono::system_clock::time_point sendTime = found->second;
-                  TimeStampSet.erase(found);
-                  Mutex.unlock();
-                  // NOTE: The mutex is unlocked now, to prevent blocking during database processing!
-
-                  HPCT_LOG(trace) << "Updating scheduled entry ...";
-                  // std::cout << identifier << " -> " << usSinceEpoch(sendTime) << std::endl;
-                  schedulerDBTransaction.exec(
-                     "UPDATE ExperimentSchedule "
-                     "SET "
-                        "State = 'agent_completed',"
-                        "AgentMeasurementTime = " + schedulerDBTransaction.quote(timePointToStringUTC(sendTime)) + " "
-                     "WHERE "
-                        "Identifier = " + schedulerDBTransaction.quote(identifier)
-                  );
-                  updated = true;
-               }
-               else {
-                  // NOTE: The mutex is still locked -> unlock it!
-                  Mutex.unlock();
-               }
+               // Completions are handled by updateCompletions().
+               Mutex.unlock();
             }
          }
          if(updated) {
@@ -219,16 +305,21 @@ static void checkSchedule(const boost::system::error_code& errorCode,
             updateLastSeen(schedulerDBTransaction);
          }
          schedulerDBTransaction.commit();
+         removeCompletions(completedIdentifiers);
       }
       catch (const std::exception &e) {
          HPCT_LOG(warning) << "Unable to communicate with scheduler database: " << e.what();
       }
 
       // ====== Set timer for next schedule check ===========================
-      ScheduleCheckTimer.expires_at(ScheduleCheckTimer.expires_at() +
-                                    ((updated == false) ? ScheduleCheckTimerInterval : boost::posix_time::milliseconds(0)));
-      ScheduleCheckTimer.async_wait(std::bind(&checkSchedule, std::placeholders::_1,
-                                              schedulerDBConnection));
+      // NOTE: The timer must not be re-armed during shutdown, since
+      //       IOService.run() would not return then!
+      if(!ShuttingDown) {
+         ScheduleCheckTimer.expires_at(ScheduleCheckTimer.expires_at() +
+                                       ((updated == false) ? ScheduleCheckTimerInterval : boost::posix_time::milliseconds(0)));
+         ScheduleCheckTimer.async_wait(std::bind(&checkSchedule, std::placeholders::_1,
+                                                 schedulerDBConnection));
+      }
    }
 }
 
@@ -251,6 +342,13 @@ static void resultCallback(Service*              service,
                 << *resultEntry  << std::endl;
 #endif
       TimeStampSet[identifier] = resultEntry->sendTime();
+
+      // ====== Wake up the main loop to flush the completion ===============
+      // Only one flush is posted at a time; it handles all completions
+      // having arrived until then.
+      if(CompletionFlushPending.exchange(true) == false) {
+         IOService.post(std::bind(&flushCompletions, schedulerDBConnection));
+      }
    }
 }
 
@@ -524,6 +622,10 @@ int main(int argc, char** argv)
       // ====== Main loop ===================================================
       HPCT_LOG(info) << "Agent is ready!";
       IOService.run();
+
+      // ====== Write the last completions ==================================
+      // The services have finished now, i.e. no further results arrive.
+      flushCompletions(&schedulerDBConnection);
    }
    catch (const std::exception &e) {
       HPCT_LOG(warning) << "Unable to connect to scheduler database: " << e.what();